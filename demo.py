@@ -1,7 +1,40 @@
 import os
-import base64
+import io
+import queue
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import httpx
 import streamlit as st
-from openai import OpenAI
+from openai import AsyncOpenAI
+from PIL import Image, ImageOps
+
+try:
+    from pybase64 import b64encode_as_string  # SIMD base64, returns str without a .decode() copy
+except ImportError:
+    from binascii import b2a_base64
+
+    def b64encode_as_string(data):
+        # Skips base64.b64encode's wrapper; same output
+        return b2a_base64(data, newline=False).decode("ascii")
+
+try:
+    import pyvips  # SIMD, streaming resize; much faster than Pillow on large photos
+except (ImportError, OSError):  # OSError: binding installed but libvips missing
+    pyvips = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 """
 Streamlit **multimodal chatbot** for vLLM (OpenAI‑compatible) servers
@@ -14,115 +47,428 @@ Streamlit **multimodal chatbot** for vLLM (OpenAI‑compatible) servers
   avoid the “at most 1 image per request” error.
 
 ```bash
-pip install streamlit vllm[pillow] "openai>=1.0"
+pip install streamlit vllm[pillow] "openai>=1.0" "httpx[http2]" pybase64 orjson pyvips
 python -m vllm.entrypoints.openai.api_server \
     --model liuhaotian/llava-v1.6-34b \
     --image-input-size 576
 ```
 """
 
+MAX_IMAGE_SIDE = int(os.getenv("VLLM_IMAGE_SIDE", "576"))  # Match the server's image input size
+IMG_CACHE_SIZE = 4    # Recently prepared images kept per session for quick switching
+HISTORY_TURNS = 8     # Assistant/user exchanges sent after the pinned first turn
+IMAGE_REF = "cid:current"  # Stands in for the image URL inside chat history
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant that can see images when provided."}
+
 st.set_page_config(page_title="vLLM Vision Chatbot", layout="centered")
 st.title("🖼️📨 vLLM Vision Chatbot")
 
+# ─────────────────── Helper: cached OpenAI client ───────────────────
+
+@st.cache_resource
+def event_loop():
+    # One background loop shared by all sessions; the async client lives on it
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def get_client(base, key):
+    # One pooled keep‑alive (HTTP/2 when h2 is installed) client per server, reused across reruns
+    http_client = httpx.AsyncClient(
+        http2=find_spec("h2") is not None,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60),
+    )
+    return AsyncOpenAI(api_key=key or "EMPTY", base_url=base.rstrip("/"), http_client=http_client)
+
 # ───────────────────────────── Sidebar ──────────────────────────────
-with st.sidebar:
+# Fragments: editing these settings reruns only the sidebar, and chatting reruns
+# only the chat panel. Values are shared through the widgets' session‑state keys.
+@st.fragment
+def sidebar_panel():
     st.header("🔌 Connection Settings")
 
-    server_url = st.text_input("vLLM Server URL", value=os.getenv("VLLM_SERVER_URL", "http://localhost:8000/v1"))
-    api_key = st.text_input("API Key (optional)", type="password", value=os.getenv("OPENAI_API_KEY", ""))
-    model = st.text_input("Model name on server", value=os.getenv("VLLM_MODEL", "liuhaotian/llava-v1.6-34b"))
+    st.text_input("vLLM Server URL", value=os.getenv("VLLM_SERVER_URL", "http://localhost:8000/v1"), key="server_url")
+    st.text_input("API Key (optional)", type="password", value=os.getenv("OPENAI_API_KEY", ""), key="api_key")
+    st.text_input("Model name on server", value=os.getenv("VLLM_MODEL", "liuhaotian/llava-v1.6-34b"), key="model")
 
-    if not server_url:
+    if not st.session_state.server_url:
         st.error("Enter server URL, e.g. http://localhost:8000/v1")
         st.stop()
 
-    client = OpenAI(api_key=api_key or "EMPTY", base_url=server_url.rstrip("/"))
-
     st.markdown(
         "*Tip*: Upload an image anytime; it will be attached **once** then you can keep chatting. "
         "Uploading a new image resets the conversation so there is never more than one image in a single request.")
 
-# ───────────────────── Helper: image ➜ base64 URL ─────────────────────
 
-def image_to_data_url(file):
-    mime_type = file.type
-    encoded = base64.b64encode(file.getvalue()).decode()
-    return f"data:{mime_type};base64,{encoded}"
+with st.sidebar:
+    sidebar_panel()
+
+# ───────────────────── Helper: image ➜ URL ─────────────────────
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    """Serves uploaded images from memory so vLLM can fetch them by URL."""
+
+    def do_GET(self):
+        # State lives on the cached server: this class is redefined on every rerun
+        item = self.server.store.get(self.path.lstrip("/"))
+        if item is None:
+            self.send_error(404)
+            return
+        mime, data = item
+        self.send_response(200)
+        self.send_header("Content-Type", mime)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@st.cache_resource
+def image_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ImageHandler)  # port 0 ➜ any free port
+    server.store = {}      # "<digest>.jpg" -> (mime, bytes)
+    server.pinned = OrderedDict()  # session id -> name its chat prefix points at, LRU order
+    server.max_pins = 24   # Most recently active chats whose image is never evicted
+    server.max_entries = 32  # Hard cap: always > max_pins, so unpinned eviction can reach it
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def is_local_server(url):
+    return urlparse(url).hostname in ("localhost", "127.0.0.1", "::1")
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def downscale(data: bytes) -> bytes:
+    """Shrink to the model's input size and re‑encode as a 4:2:0 JPEG q=75."""
+    if pyvips is not None:
+        img = pyvips.Image.thumbnail_buffer(data, MAX_IMAGE_SIDE, height=MAX_IMAGE_SIDE, size="down")
+        if img.hasalpha():
+            img = img.flatten(background=[255, 255, 255])
+        return img.jpegsave_buffer(Q=75, strip=True, optimize_coding=True, subsample_mode="on")
+
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))  # Same orientation as pyvips' autorotate
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    if img.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white rather than letting it turn black
+        img = img.convert("RGBA")
+        img = Image.alpha_composite(Image.new("RGBA", img.size, (255, 255, 255, 255)), img)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=75, subsampling=2, optimize=True)
+    return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def make_thumb(data: bytes) -> bytes:
+    """Small PNG for the in‑page preview, built once per upload instead of every rerun."""
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))  # The browser no longer sees the EXIF
+    img.thumbnail((512, 512))
+    if img.mode not in ("1", "L", "LA", "I", "P", "RGB", "RGBA"):  # e.g. CMYK JPEGs can't be written as PNG
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    out = io.BytesIO()
+    img.save(out, "PNG", optimize=False, compress_level=1)  # Fast to write; it never leaves the app
+    return out.getvalue()
+
+
+def pin_image(server, sid, name):
+    # Keep `name` served while this session's chat is among the most recently active
+    with server.lock:
+        server.pinned[sid] = name
+        server.pinned.move_to_end(sid)
+        while len(server.pinned) > server.max_pins:
+            server.pinned.popitem(last=False)
+
+
+def image_to_url(data, name, server):
+    """Publish JPEG bytes on the local image server and return their http URL.
+
+    Only a ~100 byte URL travels in each request instead of the whole image.
+    """
+    with server.lock:
+        store = server.store
+        if name not in store:
+            in_use = set(server.pinned.values())
+            for old in [n for n in store if n not in in_use]:
+                if len(store) < server.max_entries:
+                    break
+                del store[old]
+            store[name] = ("image/jpeg", data)
+    return f"http://127.0.0.1:{server.server_port}/{name}"
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _encode(data: bytes, mime: str) -> str:
+    # Cached on the raw bytes so Streamlit reruns don't re-encode the same upload
+    return f"data:{mime};base64,{b64encode_as_string(data)}"
+
+
+def image_to_data_url(data):
+    # Fallback for remote vLLM servers that cannot reach our local image server
+    return _encode(data, "image/jpeg")
+
+
+def prepare_image(data, name, server):
+    """Downscale + publish/encode an upload; runs on `encode_pool()` so the preview isn't blocked."""
+    jpeg = downscale(data)
+    return image_to_url(jpeg, name, server) if server else image_to_data_url(jpeg)
+
+
+@st.cache_resource
+def encode_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def drop_image(error, future=None):
+    """Forget the current upload after it failed to decode or resize, and say why."""
+    if future is not None:
+        cache = st.session_state.img_cache
+        for key in [k for k, fut in cache.items() if fut is future]:
+            del cache[key]
+    st.session_state.pending_image = None
+    st.session_state.last_image_digest = None  # Re‑uploading the same file retries it
+    st.error(f"❌ Could not process the image: {error}")
+
+
+def prefix_digest(prefix):
+    return hashlib.sha256(json.dumps(prefix, sort_keys=True).encode()).hexdigest()
+
+
+def materialize(msg, image_url):
+    """Return `msg` with the IMAGE_REF placeholder swapped for the real image URL."""
+    if not isinstance(msg["content"], list):
+        return msg
+    return {**msg, "content": [
+        {"type": "image_url", "image_url": {"url": image_url}} if c.get("image_url", {}).get("url") == IMAGE_REF else c
+        for c in msg["content"]
+    ]}
+
+
+def recent_turns(messages, k=HISTORY_TURNS):
+    # Everything after the pinned first turn, capped to the last k exchanges so the
+    # request body and vLLM's uncached prefill stay bounded. Starts on an assistant
+    # turn, so roles still alternate after the prefix.
+    return messages[1:][-2 * k:]
+
+
+async def sse_chunks(client, **params):
+    """Yield raw chunk dicts from the chat SSE stream.
+
+    Reading the lines ourselves skips building a pydantic ChatCompletionChunk
+    per token when only the delta text is needed.
+    """
+    async with client.chat.completions.with_streaming_response.create(stream=True, **params) as response:
+        async for line in response.iter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[6:]
+            if data == "[DONE]":
+                break
+            chunk = json_loads(data)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"].get("message", chunk["error"]))
+            yield chunk
+
+
+async def _pump(stream, q):
+    """Runs on `event_loop()`: move chunks into `q`, ending with None or the error.
+
+    put_nowait never blocks the loop shared by every session; the reader
+    drains continuously, so the queue stays short.
+    """
+    try:
+        async for chunk in stream:
+            q.put_nowait(chunk)
+    except Exception as e:
+        q.put_nowait(e)
+        return
+    q.put_nowait(None)
+
+
+def stream_reply(stream):
+    """Yield the text deltas of an async chunk stream pumped on `event_loop()`.
+
+    The loop keeps reading the socket while this thread renders, so socket
+    jitter doesn't stall rendering. Deltas are coalesced so st.write_stream
+    re‑renders every 16 tokens / 50 ms or at a sentence end, and whatever is
+    pending is flushed whenever the queue goes quiet.
+    """
+    q = queue.Queue()
+    fut = asyncio.run_coroutine_threadsafe(_pump(stream, q), event_loop())
+    try:
+        pending = []
+        last_flush = time.monotonic()
+        while True:
+            try:
+                chunk = q.get(timeout=0.03)
+            except queue.Empty:
+                if pending:
+                    yield "".join(pending)
+                    pending.clear()
+                    last_flush = time.monotonic()
+                continue
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk["choices"]:  # Trailing usage‑only chunk (include_usage)
+                st.session_state.last_usage = chunk.get("usage")
+                continue
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                pending.append(content)
+                if len(pending) >= 16 or time.monotonic() - last_flush > 0.05 or content.endswith((".", "?", "!", "\n")):
+                    yield "".join(pending)
+                    pending.clear()
+                    last_flush = time.monotonic()
+        if pending:
+            yield "".join(pending)
+    finally:
+        # Leaving early (rerun, stop, navigation) must not keep reading on the shared
+        # loop: cancelling closes the SSE generator and its HTTP response.
+        fut.cancel()
 
 # ─────────────────── Session‑state bootstrap ───────────────────
 if "messages" not in st.session_state:
     st.session_state.messages = []        # Conversation history
 if "pending_image" not in st.session_state:
-    st.session_state.pending_image = None # Data URL to send with next user msg
-if "last_image_data_url" not in st.session_state:
-    st.session_state.last_image_data_url = None  # Tracks current image in session
+    st.session_state.pending_image = None # Future ➜ image URL to send with next user msg
+if "last_image_digest" not in st.session_state:
+    st.session_state.last_image_digest = None  # Tracks current image in session
+if "img_cache" not in st.session_state:
+    st.session_state.img_cache = {}  # (digest, port) -> Future of prepared image URL
+if "last_file_id" not in st.session_state:
+    st.session_state.last_file_id = None  # Uploader file_id the digest was built from
+if "image_url" not in st.session_state:
+    st.session_state.image_url = None  # The one full copy of the image URL in use
+if "image_name" not in st.session_state:
+    st.session_state.image_name = None  # Name on the local image server, if served there
+if "thumb" not in st.session_state:
+    st.session_state.thumb = None  # PNG preview of the current upload
+if "sid" not in st.session_state:
+    st.session_state.sid = uuid.uuid4().hex  # Tags this chat's requests on the server
+if "stable_prefix" not in st.session_state:
+    st.session_state.stable_prefix = None # (system, first user turn), never mutated
 
 # ───────────────────────── Image upload ─────────────────────────
 uploaded_file = st.file_uploader("Optional image (PNG/JPG/WebP)", type=["png", "jpg", "jpeg", "webp"])
 if uploaded_file:
-    data_url = image_to_data_url(uploaded_file)
-
-    # Detect a *new* image compared to what was already in context
-    if data_url != st.session_state.last_image_data_url:
-        # Start a fresh conversation to ensure only one image per request
-        st.session_state.messages.clear()
-        st.session_state.pending_image = data_url
-        st.session_state.last_image_data_url = data_url
-    else:
-        # Same image re‑selected; don’t reset chat, just preview
-        if st.session_state.pending_image is None:  # Already consumed earlier
-            st.info("This image is already in context; ask a follow‑up question!")
-
-    st.image(uploaded_file, use_column_width=True)
-
-# ───────────────────────── Chat history render ─────────────────────────
-for msg in st.session_state.messages:
-    with st.chat_message(msg["role"]):
-        if msg["role"] == "user" and isinstance(msg["content"], list):
-            text = next((c.get("text", "") for c in msg["content"] if c["type"] == "text"), "")
-            st.markdown(text)
+    # Only look at the bytes when a different upload arrives, not on every rerun
+    if uploaded_file.file_id != st.session_state.last_file_id:
+        data = uploaded_file.getvalue()  # The BytesIO's own bytes, not a copy
+        try:
+            thumb = make_thumb(data)  # Also proves the upload decodes
+        except Exception as e:
+            # Not recorded as handled, so the error stays up until a different file is chosen
+            st.session_state.thumb = None
+            drop_image(e)
         else:
-            st.markdown(msg["content"])
-
-# ───────────────────────── Chat input ─────────────────────────
-user_text = st.chat_input("Message…")
-if user_text:
-    # Build user content with optional pending image
-    if st.session_state.pending_image:
-        user_content = [
-            {"type": "image_url", "image_url": {"url": st.session_state.pending_image}},
-            {"type": "text", "text": user_text},
-        ]
-        st.session_state.pending_image = None  # Consume image after first use
-    else:
+            st.session_state.last_file_id = uploaded_file.file_id
+            st.session_state.thumb = thumb
+            digest = hashlib.blake2b(data, digest_size=16).digest()  # Faster than SHA‑256 here
+
+            # Detect a *new* image compared to what was already in context
+            if digest != st.session_state.last_image_digest:
+                # Start a fresh conversation to ensure only one image per request
+                st.session_state.messages.clear()
+                st.session_state.stable_prefix = None
+                server = image_server() if is_local_server(st.session_state.server_url) else None
+                port = server.server_port if server else None
+                name = digest.hex() + ".jpg"
+                if server:
+                    pin_image(server, st.session_state.sid, name)
+                st.session_state.image_name = name if server else None
+                cache = st.session_state.img_cache
+                cached = cache.get((digest, port))
+                if cached is None or (server and cached.done() and name not in server.store):
+                    cache.pop((digest, port), None)
+                    while len(cache) >= IMG_CACHE_SIZE:
+                        cache.pop(next(iter(cache)))  # FIFO
+                    # Resize/encode in the background while the preview below renders
+                    cache[digest, port] = encode_pool().submit(prepare_image, data, name, server)
+                st.session_state.pending_image = cache[digest, port]
+                st.session_state.last_image_digest = digest
+
+    # Same image re‑selected; don’t reset chat, just preview
+    if st.session_state.pending_image is None and st.session_state.last_image_digest:  # Already consumed earlier
+        st.info("This image is already in context; ask a follow‑up question!")
+
+    if st.session_state.thumb is not None:
+        st.image(st.session_state.thumb, width="stretch")
+
+# ───────────────────────── Chat panel ─────────────────────────
+@st.fragment
+def chat_panel():
+    # The sidebar's guard only stops its own fragment when the URL is cleared
+    if not st.session_state.server_url:
+        st.stop()
+
+    # ───────────────────────── Chat history render ─────────────────────────
+    for msg in st.session_state.messages:
+        with st.chat_message(msg["role"]):
+            if msg["role"] == "user":
+                st.markdown(msg["content"][-1]["text"])  # Text part is always last
+            else:
+                st.markdown(msg["content"])
+
+    # ───────────────────────── Chat input ─────────────────────────
+    user_text = st.chat_input("Message…")
+    if user_text:
+        # Build user content with optional pending image
         user_content = [{"type": "text", "text": user_text}]
+        pending = st.session_state.pending_image
+        if pending:
+            st.session_state.pending_image = None  # Consume image after first use
+            try:
+                st.session_state.image_url = pending.result()
+                user_content.insert(0, {"type": "image_url", "image_url": {"url": IMAGE_REF}})
+            except Exception as e:
+                drop_image(e, pending)  # Send the text alone
 
-    st.session_state.messages.append({"role": "user", "content": user_content})
+        st.session_state.messages.append({"role": "user", "content": user_content})
 
-    with st.chat_message("user"):
-        st.markdown(user_text)
+        # Freeze system + first (image‑bearing) turn so every request starts with a
+        # byte‑identical prefix and vLLM's prefix cache can skip re‑prefilling it.
+        if st.session_state.stable_prefix is None:
+            first_turn = materialize(st.session_state.messages[0], st.session_state.image_url)
+            st.session_state.stable_prefix = (SYSTEM_MESSAGE, first_turn)
+            st.session_state.prefix_digest = prefix_digest(st.session_state.stable_prefix)
+        assert prefix_digest(st.session_state.stable_prefix) == st.session_state.prefix_digest, "request prefix changed"
+
+        with st.chat_message("user"):
+            st.markdown(user_text)
+
+        # ───────────────────── vLLM call (stream) ─────────────────────
+        with st.chat_message("assistant"):
+            try:
+                if st.session_state.image_name:
+                    # Each turn refetches the image; keep it in the recently‑used pins
+                    pin_image(image_server(), st.session_state.sid, st.session_state.image_name)
+                client = get_client(st.session_state.server_url, st.session_state.api_key)
+                stream = sse_chunks(
+                    client,
+                    model=st.session_state.model,
+                    messages=[*st.session_state.stable_prefix, *recent_turns(st.session_state.messages)],
+                    stream_options={"include_usage": True},
+                    user=st.session_state.sid,
+                )
+                st.session_state.last_usage = None
+                assistant_reply = st.write_stream(stream_reply(stream))
+
+                # vLLM reports prefix‑cache hits when started with --enable-prompt-tokens-details
+                usage = st.session_state.last_usage or {}
+                details = usage.get("prompt_tokens_details") or {}
+                if details.get("cached_tokens") is not None:
+                    st.caption(f"{details['cached_tokens']}/{usage['prompt_tokens']} prompt tokens served from cache")
+            except Exception as e:
+                assistant_reply = f"❌ Error: {e}"
+                st.error(assistant_reply)
+
+        st.session_state.messages.append({"role": "assistant", "content": assistant_reply})
 
-    # ───────────────────── vLLM call (stream) ─────────────────────
-    with st.chat_message("assistant"):
-        placeholder = st.empty()
-        assistant_reply = ""
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that can see images when provided."},
-                    *st.session_state.messages,
-                ],
-                stream=True,
-            )
-            for chunk in response:
-                delta = chunk.choices[0].delta
-                if delta and delta.content:
-                    assistant_reply += delta.content
-                    placeholder.markdown(assistant_reply + "▌")
-            placeholder.markdown(assistant_reply)
-        except Exception as e:
-            assistant_reply = f"❌ Error: {e}"
-            placeholder.error(assistant_reply)
 
-    st.session_state.messages.append({"role": "assistant", "content": assistant_reply})
+chat_panel()